@@ -1,19 +1,31 @@
 import os
+import io
 import json
 import asyncio
+import logging
+import hashlib
+import hmac
+import tempfile
+import time
 import uvicorn
+import aiohttp
+import orjson
+from collections import OrderedDict, deque
+from itertools import count
 from pathlib import Path
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Security
 from fastapi.security import APIKeyHeader
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
 from jinja2 import Environment, FileSystemLoader
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, Browser, BrowserContext
 
-from azure.ai.contentunderstanding import ContentUnderstandingClient
+from azure.ai.contentunderstanding.aio import ContentUnderstandingClient
 from azure.core.credentials import AzureKeyCredential
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import AzureError, HttpResponseError
+from azure.core.pipeline.transport import AioHttpTransport
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -23,132 +35,580 @@ AI_ENDPOINT = os.getenv("AZURE_AI_ENDPOINT")
 AI_KEY = os.getenv("AZURE_AI_KEY")
 ANALYZER_ID = os.getenv("ANALYZER_ID")
 
+# PDF rendering engine: "playwright" (Chromium) or "weasyprint" (in-process)
+PDF_ENGINE = os.getenv("PDF_ENGINE", "playwright").lower()
+
+# PDF rendering pool size (per server process, Playwright engine only)
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "3"))
+PAGES_PER_BROWSER = int(os.getenv("PAGES_PER_BROWSER", "5"))
+CONTEXT_MAX_RENDERS = int(os.getenv("CONTEXT_MAX_RENDERS", "100"))
+
+# A4 at 96 DPI, so the page lays out at the size it is printed
+A4_VIEWPORT = {"width": 794, "height": 1123}
+
+# Seconds a /health result is reused before Azure AI is checked again
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "10"))
+
+# Seconds the /health Azure AI check may take to connect or respond
+HEALTH_PROBE_TIMEOUT = 5
+
+# Seconds the startup analyzer schema fetch may take to connect or respond
+SCHEMA_FETCH_TIMEOUT = 5
+
+# Content type sent to Azure when the upload doesn't declare one
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+# Chunk size used when streaming generated PDFs back to the client
+PDF_CHUNK_SIZE = 64 * 1024
+
+# Number of recently generated PDFs kept in memory (per server process, 0 disables)
+PDF_CACHE_SIZE = int(os.getenv("PDF_CACHE_SIZE", "64"))
+
+# Cap on open connections to Azure AI (per server process). Set well above
+# AZURE_CONCURRENCY so in-flight analyses, their status polls and /health
+# checks never wait on each other for a connection
+AZURE_POOL_SIZE = int(os.getenv("AZURE_POOL_SIZE", "50"))
+
+# Max in-flight Azure AI analyses (per server process); bursts beyond ~30
+# concurrent SDK operations have been seen to stall for ~20s
+AZURE_CONCURRENCY = int(os.getenv("AZURE_CONCURRENCY", "15"))
+
 # Will throw an error if the .env file is not set
 if not AI_ENDPOINT or not AI_KEY:
     raise ValueError("AZURE_AI_ENDPOINT and AZURE_AI_KEY must be set in the .env file")
 
+if PDF_ENGINE not in ("playwright", "weasyprint"):
+    raise ValueError("PDF_ENGINE must be either 'playwright' or 'weasyprint'")
+
+# WeasyPrint is an optional dependency, only imported when selected
+if PDF_ENGINE == "weasyprint":
+    from weasyprint import HTML
+
+logger = logging.getLogger(__name__)
+
 # API Key Security
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 async def verify_api_key(api_key: str = Security(api_key_header)):
-    if api_key != AI_KEY:
+    # Constant-time comparison so response timing doesn't leak the key
+    if not api_key or not hmac.compare_digest(api_key.encode(), AI_KEY.encode()):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
+# Last Azure AI connection check, shared by /health calls within the TTL
+health_cache = {"checked_at": None, "error": None}
+
+# LRU cache of rendered PDFs, keyed by a hash of the invoice data
+pdf_cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+
+# Limits concurrent analyses sent to Azure; extra requests wait their turn
+azure_semaphore = asyncio.Semaphore(AZURE_CONCURRENCY)
+
 # Initialize FastAPI with global API key protection
 app = FastAPI(
     title="Invoice Extraction and Generator API",
-    dependencies=[Depends(verify_api_key)]  # Protects ALL endpoints
+    dependencies=[Depends(verify_api_key)],  # Protects ALL endpoints
+    default_response_class=ORJSONResponse  # Faster JSON encoding, native datetime support
 )
 
-# Initialize Azure AI Client
-client = ContentUnderstandingClient(
-    endpoint=AI_ENDPOINT,
-    credential=AzureKeyCredential(AI_KEY)
+# Load and compile the invoice template once; auto_reload is off because the
+# template only changes on redeploy
+template_dir = Path(__file__).parent
+jinja_env = Environment(
+    loader=FileSystemLoader(str(template_dir)),
+    auto_reload=False
 )
+invoice_template = jinja_env.get_template("template.html")
+
+
+class UploadStream(io.RawIOBase):
+    """
+    Seekable view of an uploaded file whose close() does nothing.
+    
+    aiohttp closes a file request body once it has been sent, which would
+    stop azure-core from rewinding it to retry a throttled (429/503) analyze
+    call. Starlette still closes the underlying file after the request.
+    """
+
+    def __init__(self, file):
+        self._file = file
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readinto(self, buffer):
+        data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        pass
+
+
+class PooledContext:
+    """A BrowserContext of a pooled browser, with the counts used to recycle it."""
+
+    def __init__(self, owner: "PooledBrowser", context: BrowserContext):
+        self.owner = owner
+        self.context = context
+        self.renders = 0      # Pages ever opened in this context
+        self.open_pages = 0   # Pages currently open in this context
+        self.retired = False  # No new pages; closed once open_pages hits 0
+
+
+class PooledBrowser:
+    """A pooled Chromium browser and the shared context new pages open in."""
+
+    def __init__(self, browser: Browser):
+        self.browser = browser
+        self.current: PooledContext | None = None
+        self.lock = asyncio.Lock()
+
+
+class BrowserPool:
+    """
+    Keeps a set of warm Chromium browsers alive for the lifetime of the app,
+    so /generate-pdf never pays the browser cold start. Each browser has
+    max_pages_per_browser slots in a queue; acquire() blocks when all slots
+    are busy, which also bounds the number of concurrent renders.
+    
+    New pages open in the browser's current shared BrowserContext. After
+    max_renders_per_context renders that context is retired: later
+    acquisitions get a fresh one, and release() closes the retired context
+    once its last open page is done. A browser that has crashed or
+    disconnected is relaunched on its next acquire().
+    """
+
+    def __init__(self, max_browsers: int, max_pages_per_browser: int, max_renders_per_context: int):
+        self.max_browsers = max_browsers
+        self.max_pages_per_browser = max_pages_per_browser
+        self.max_renders_per_context = max_renders_per_context
+        self._playwright = None
+        self._browsers: list[PooledBrowser] = []
+        self._slots: asyncio.Queue[PooledBrowser] = asyncio.Queue()
+
+    async def start(self):
+        self._playwright = await async_playwright().start()
+        for _ in range(self.max_browsers):
+            pooled = PooledBrowser(await self._playwright.chromium.launch())
+            await self._refresh(pooled)
+            self._browsers.append(pooled)
+            for _ in range(self.max_pages_per_browser):
+                self._slots.put_nowait(pooled)
+
+    async def acquire(self) -> PooledContext:
+        """Wait for a free slot; open one page in the returned .context."""
+        pooled = await self._slots.get()
+        try:
+            async with pooled.lock:
+                await self._refresh(pooled)
+                leased = pooled.current
+                leased.renders += 1
+                leased.open_pages += 1
+        except Exception:
+            self._slots.put_nowait(pooled)
+            raise
+        return leased
+
+    async def release(self, leased: PooledContext):
+        leased.open_pages -= 1
+        self._slots.put_nowait(leased.owner)
+        # The last page of a retired context is closed, so drop the context
+        if leased.retired and leased.open_pages == 0:
+            await self._close_context(leased)
+
+    async def _refresh(self, pooled: PooledBrowser):
+        current = pooled.current
+        # Relaunch a browser that crashed or was closed
+        if not pooled.browser.is_connected():
+            pooled.browser = await self._playwright.chromium.launch()
+            pooled.current = None
+        # Once a context has served enough renders, new pages go to a fresh
+        # one straight away so per-context memory (caches, renderer state)
+        # can't creep under steady load; pages still open finish in the old one
+        elif current is not None and current.renders >= self.max_renders_per_context:
+            pooled.current = None
+
+        if current is not None and pooled.current is None:
+            current.retired = True
+            if current.open_pages == 0:
+                await self._close_context(current)
+
+        if pooled.current is None:
+            context = await pooled.browser.new_context(viewport=A4_VIEWPORT)
+            pooled.current = PooledContext(pooled, context)
+
+    async def _close_context(self, retired: PooledContext):
+        try:
+            await retired.context.close()
+        except Exception:
+            pass  # Its browser has already gone away
+
+    async def close(self):
+        for pooled in self._browsers:
+            await pooled.browser.close()
+        self._browsers.clear()
+        if self._playwright:
+            await self._playwright.stop()
+            self._playwright = None
+
+
+@app.on_event("startup")
+async def on_startup():
+    # Launch the browsers once per process instead of once per request
+    app.state.browser_pool = None
+    if PDF_ENGINE == "playwright":
+        app.state.browser_pool = BrowserPool(
+            max_browsers=BROWSER_POOL_SIZE,
+            max_pages_per_browser=PAGES_PER_BROWSER,
+            max_renders_per_context=CONTEXT_MAX_RENDERS
+        )
+        await app.state.browser_pool.start()
+
+    # Shared HTTP session for Azure AI. Idle connections are kept alive for
+    # 60s (aiohttp's default is 15s) so requests reuse them instead of
+    # re-handshaking, and the pool is capped at AZURE_POOL_SIZE. Created here
+    # because aiohttp sessions must belong to the running event loop.
+    app.state.azure_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=AZURE_POOL_SIZE, keepalive_timeout=60)
+    )
+
+    # Initialize the async Azure AI Client, so long-running analyses are
+    # awaited on the event loop instead of pinning a worker thread each
+    app.state.ai_client = ContentUnderstandingClient(
+        endpoint=AI_ENDPOINT,
+        credential=AzureKeyCredential(AI_KEY),
+        transport=AioHttpTransport(session=app.state.azure_session, session_owner=False)
+    )
+
+    # Build a serializer specialized to the analyzer's schema; without one
+    # (e.g. schema unavailable) every request uses the generic serialize_field.
+    # No retries and a short timeout: uvicorn doesn't accept connections until
+    # startup finishes, so a slow or unreachable Azure mustn't hold it up
+    app.state.extract_fields = None
+    try:
+        analyzer = await app.state.ai_client.get_analyzer(
+            ANALYZER_ID,
+            retry_total=0,
+            connection_timeout=SCHEMA_FETCH_TIMEOUT,
+            read_timeout=SCHEMA_FETCH_TIMEOUT
+        )
+        app.state.extract_fields = compile_field_extractor(analyzer.as_dict().get("fieldSchema") or {})
+    except Exception as e:
+        logger.warning("Using generic field serializer, analyzer schema unavailable: %s", e)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if app.state.browser_pool:
+        await app.state.browser_pool.close()
+    await app.state.ai_client.close()
+    await app.state.azure_session.close()
+
+async def iter_file(path: str, chunk_size: int = PDF_CHUNK_SIZE):
+    """Yield a file's contents in chunks, reading off the event loop."""
+    loop = asyncio.get_running_loop()
+    with open(path, "rb") as f:
+        while chunk := await loop.run_in_executor(None, f.read, chunk_size):
+            yield chunk
+
+async def render_pdf(rendered_html: str, pdf_path: str | None = None) -> bytes:
+    """
+    Render HTML to an A4 PDF with the configured PDF_ENGINE and return the
+    bytes. If pdf_path is given, the PDF is also written there.
+    """
+    if PDF_ENGINE == "weasyprint":
+        return await asyncio.to_thread(render_pdf_weasyprint, rendered_html, pdf_path)
+    return await render_pdf_playwright(rendered_html, pdf_path)
+
+def render_pdf_weasyprint(rendered_html: str, pdf_path: str | None = None) -> bytes:
+    """Render HTML to a PDF in-process with WeasyPrint (blocking)."""
+    # Page size and margins come from the template's @page rule
+    pdf_bytes = HTML(string=rendered_html, base_url=str(template_dir)).write_pdf()
+    if pdf_path:
+        with open(pdf_path, "wb") as f:
+            f.write(pdf_bytes)
+    return pdf_bytes
+
+async def render_pdf_playwright(rendered_html: str, pdf_path: str | None = None) -> bytes:
+    """Render HTML to an A4 PDF using a pooled Playwright page."""
+    pool = app.state.browser_pool
+    leased = await pool.acquire()
+    try:
+        # Short-lived page in the browser's shared context
+        page = await leased.context.new_page()
+        try:
+            # The template is self-contained (inline CSS, system fonts), so there
+            # is nothing to wait for once the DOM is parsed
+            await page.set_content(rendered_html, wait_until="domcontentloaded")
+
+            return await page.pdf(
+                path=pdf_path,
+                format="A4",
+                print_background=True,
+                margin={
+                    "top": "0mm",
+                    "bottom": "0mm",
+                    "left": "0mm",
+                    "right": "0mm"
+                }
+            )
+        finally:
+            await page.close()
+    finally:
+        await pool.release(leased)
+
+def azure_json_default(obj):
+    """orjson fallback for Azure SDK models; anything else is stringified."""
+    if hasattr(obj, "as_dict"):
+        try:
+            return obj.as_dict()
+        except Exception:
+            pass
+    return str(obj)
+
+# Value keys Azure uses for extracted primitives, in priority order
+PRIMITIVE_VALUE_KEYS = ("valueString", "valueNumber", "valueDate")
+TYPED_VALUE_ATTRS = ("value_string", "value_number", "value_date", "value")
+
+def serialize_field(field):
+    """
+    Convert Azure SDK field objects to clean JSON-serializable types.
+    
+    Azure Content Understanding fields are dict-like with structure:
+    - valueString / valueNumber / valueDate for primitives
+    - valueObject for nested objects (each sub-field is processed in turn)
+    - valueArray for arrays (each item is processed in turn)
+    - If no value key exists, Azure couldn't extract it → return None
+    
+    Nested fields are walked with an explicit stack rather than recursion:
+    each work item is (container, key_or_index, field) and the serialized
+    value is written into container[key_or_index].
+    """
+    root = [None]
+    stack = deque([(root, 0, field)])
+
+    while stack:
+        container, slot, node = stack.pop()
+
+        if node is None:
+            continue  # Slot is already None
+
+        # Fallback for non-dict SDK objects (e.g. typed field classes)
+        if not hasattr(node, "get"):
+            for attr in TYPED_VALUE_ATTRS:
+                val = getattr(node, attr, None)
+                if val is not None:
+                    container[slot] = val if isinstance(val, (str, int, float, bool)) else str(val)
+                    break
+            continue
+
+        # Check for actual extracted values in priority order
+        for value_key in PRIMITIVE_VALUE_KEYS:
+            val = node.get(value_key)
+            if val is not None:
+                container[slot] = val
+                break
+        else:
+            # Nested object: queue each sub-field, keeping key order
+            obj = node.get("valueObject")
+            if obj is not None:
+                out = container[slot] = dict.fromkeys(obj)
+                stack.extend((out, k, v) for k, v in obj.items())
+                continue
+
+            # Array: queue each item into a pre-sized list
+            items = node.get("valueArray")
+            if items is not None:
+                out = container[slot] = [None] * len(items)
+                stack.extend((out, i, item) for i, item in enumerate(items))
+
+            # No value key found → Azure couldn't extract this field (stays None)
+
+    return root[0]
+
+# Value key Azure sets for each primitive schema field type
+SCHEMA_VALUE_KEYS = {"string": "valueString", "number": "valueNumber", "date": "valueDate"}
+
+def compile_field_extractor(field_schema: dict):
+    """
+    Generate a serializer specialized to an analyzer's field schema.
+    
+    Returns a function equivalent to running serialize_field over every
+    entry of content.fields, but with the known field names and value keys
+    baked in, so no value keys are probed at runtime. The generated code
+    raises KeyError when Azure returns a field outside the schema, and
+    callers should fall back to serialize_field.
+    Returns None if the schema uses types the generic walker doesn't cover.
+    """
+    lines = ["def extract_fields(fields):", "    out = {}"]
+    names = count()
+
+    def emit(src: str, definition: dict, dest: str, indent: str) -> bool:
+        field_type = definition.get("type")
+
+        if field_type in SCHEMA_VALUE_KEYS:
+            lines.append(f"{indent}{dest} = {src}.get({SCHEMA_VALUE_KEYS[field_type]!r})")
+            return True
+
+        if field_type == "object":
+            obj, out = f"o{next(names)}", f"d{next(names)}"
+            lines.append(f"{indent}{obj} = {src}.get('valueObject')")
+            lines.append(f"{indent}if {obj} is None:")
+            lines.append(f"{indent}    {dest} = None")
+            lines.append(f"{indent}else:")
+            lines.append(f"{indent}    {out} = {dest} = {{}}")
+            return emit_mapping(obj, definition.get("properties") or {}, out, indent + "    ")
+
+        if field_type == "array":
+            arr, out = f"a{next(names)}", f"l{next(names)}"
+            index, item = f"n{next(names)}", f"i{next(names)}"
+            lines.append(f"{indent}{arr} = {src}.get('valueArray')")
+            lines.append(f"{indent}if {arr} is None:")
+            lines.append(f"{indent}    {dest} = None")
+            lines.append(f"{indent}else:")
+            lines.append(f"{indent}    {dest} = {out} = [None] * len({arr})")
+            lines.append(f"{indent}    for {index}, {item} in enumerate({arr}):")
+            return emit(item, definition.get("items") or {}, f"{out}[{index}]", indent + "        ")
+
+        return False
+
+    def emit_mapping(src: str, properties: dict, out: str, indent: str) -> bool:
+        # Only keys Azure returned are copied, like the generic walker;
+        # any key outside the schema means the shape is unknown
+        for name, definition in properties.items():
+            lines.append(f"{indent}if {name!r} in {src}:")
+            if not emit(f"{src}[{name!r}]", definition, f"{out}[{name!r}]", indent + "    "):
+                return False
+        lines.append(f"{indent}if len({out}) != len({src}):")
+        lines.append(f"{indent}    raise KeyError('field not in analyzer schema')")
+        return True
+
+    if not emit_mapping("fields", field_schema.get("fields") or {}, "out", "    "):
+        return None
+    lines.append("    return out")
+
+    namespace = {}
+    exec(compile("\n".join(lines), "<field-extractor>", "exec"), namespace)
+    return namespace["extract_fields"]
 
 # Check the health of the FastAPI application (Check if the Azure AI connection is successful)
+# Probes hit this every few seconds, so the Azure result is cached for HEALTH_CACHE_TTL
 @app.get("/health")
 async def health_check():
-    try:
-        # Attempt a lightweight call to verify credentials
-        analyzers = client.list_analyzers()
-        return {"status": "ok", "message": "Azure AI connection successful"}
+    now = time.monotonic()
+    checked_at = health_cache["checked_at"]
+    if checked_at is None or now - checked_at >= HEALTH_CACHE_TTL:
+        try:
+            # Attempt a lightweight call to verify credentials
+            # (the pager is lazy, so fetch the first item to force a request).
+            # No retries and a short timeout, so a probe fails fast when Azure
+            # is unreachable instead of sitting in the SDK's retry backoff
+            analyzers = app.state.ai_client.list_analyzers(
+                retry_total=0,
+                connection_timeout=HEALTH_PROBE_TIMEOUT,
+                read_timeout=HEALTH_PROBE_TIMEOUT
+            )
+            async for _ in analyzers:
+                break
+            health_cache["error"] = None
+        except AzureError as e:
+            # Covers HTTP errors as well as connection failures
+            # (ServiceRequestError), so both are cached for the TTL
+            health_cache["error"] = e.message
+        health_cache["checked_at"] = now
 
-    except HttpResponseError as e:
+    if health_cache["error"] is not None:
         raise HTTPException(
             status_code=500,
-            detail=f"Azure AI connection failed: {e.message}"
+            detail=f"Azure AI connection failed: {health_cache['error']}"
         )
+    return {"status": "ok", "message": "Azure AI connection successful"}
 
 @app.post("/analyze-invoice")
-async def analyze_invoice(file: UploadFile = File(...)):
+async def analyze_invoice(file: UploadFile = File(...), include_raw: bool = False):
     """
     Uploads an invoice PDF/Image, extracts data using Azure AI, 
     and returns structured JSON.
+    
+    Pass ?include_raw=true to also get the full Azure result as 'raw_result'
+    (useful for debugging, but roughly doubles the response size).
     """
     try:
-        # 1. Read the file stream
-        file_bytes = await file.read()
+        # 1. Rewind the upload; Starlette has already spooled it to a
+        # SpooledTemporaryFile, so the SDK can stream from that file object
+        # instead of us copying the whole document into a bytes buffer.
+        # UploadStream keeps the body open after sending so retries can rewind it
+        upload = UploadStream(file.file)
         
-        # 2. Send to Azure AI Content Understanding
-        # We use 'begin_analyze_binary' for binary data (file uploads)
-        poller = client.begin_analyze_binary(
-            analyzer_id=ANALYZER_ID,
-            binary_input=file_bytes,
-            content_type=file.content_type or "application/octet-stream"
-        )
+        # The wrapper has no fileno(), so aiohttp can't size the body and would
+        # fall back to chunked encoding; send an explicit Content-Length instead
+        upload_size = upload.seek(0, io.SEEK_END)
+        upload.seek(0)
         
-        # 3. Wait for the Long-Running Operation (LRO) to finish
-        # Run in a thread to avoid blocking the async event loop
-        result = await asyncio.to_thread(poller.result)
+        async with azure_semaphore:
+            # 2. Send to Azure AI Content Understanding
+            # We use 'begin_analyze_binary' for binary data (file uploads)
+            poller = await app.state.ai_client.begin_analyze_binary(
+                analyzer_id=ANALYZER_ID,
+                binary_input=upload,
+                content_type=file.content_type or DEFAULT_CONTENT_TYPE,
+                headers={"Content-Length": str(upload_size)}
+            )
+            
+            # 3. Wait for the Long-Running Operation (LRO) to finish
+            # The async poller yields to the event loop between status polls
+            result = await poller.result()
 
         # 4. Extract the 'fields' from the response
         # The result structure depends on your Schema in the Studio.
         # Usually, it's inside result.contents -> fields
         
-        def serialize_field(field):
-            """
-            Convert Azure SDK field objects to clean JSON-serializable types.
-            
-            Azure Content Understanding fields are dict-like with structure:
-            - valueString / valueNumber / valueDate for primitives
-            - valueObject for nested objects (recursively process)
-            - valueArray for arrays (recursively process)
-            - If no value key exists, Azure couldn't extract it → return None
-            """
-            if field is None:
-                return None
-            
-            # Handle dict-like SDK objects (MutableMapping)
-            if hasattr(field, "get") or isinstance(field, dict):
-                # Check for actual extracted values in priority order
-                for value_key in ["valueString", "valueNumber", "valueDate"]:
-                    if value_key in field:
-                        return field[value_key]
-                
-                # Nested object: recursively serialize each sub-field
-                if "valueObject" in field:
-                    obj = field["valueObject"]
-                    return {k: serialize_field(v) for k, v in obj.items()}
-                
-                # Array: recursively serialize each item
-                if "valueArray" in field:
-                    return [serialize_field(item) for item in field["valueArray"]]
-                
-                # No value key found → Azure couldn't extract this field
-                return None
-            
-            # Fallback for non-dict SDK objects (e.g. typed field classes)
-            for attr in ["value_string", "value_number", "value_date", "value"]:
-                val = getattr(field, attr, None)
-                if val is not None:
-                    if isinstance(val, (str, int, float, bool)):
-                        return val
-                    return str(val)
-            
-            return None
-
         extracted_data = {}
         
+        extract_fields = app.state.extract_fields
+        
         # We iterate through the contents (pages/documents)
         if result.contents:
             for content in result.contents:
                 # 'fields' contains the Key-Value pairs you defined (e.g., CustomerName)
                 if hasattr(content, "fields") and content.fields:
+                    # Fast path: serializer generated from the analyzer schema
+                    if extract_fields is not None:
+                        try:
+                            extracted_data.update(extract_fields(content.fields))
+                            continue
+                        except (KeyError, AttributeError, TypeError):
+                            pass  # Fields don't match the schema, use the generic walker
+                    
                     for field_name, field_value in content.fields.items():
                         extracted_data[field_name] = serialize_field(field_value)
 
-        # Safely serialize the raw result for debugging
-        try:
-            raw = result.as_dict()
-        except Exception:
-            raw = str(result)
-
-        return JSONResponse(content={
+        response = {
             "status": "success",
-            "data": extracted_data,
-            "raw_result": raw
-        })
+            "data": extracted_data
+        }
+
+        # Include the raw result for debugging (only on request). The SDK
+        # model is converted by orjson's default hook while encoding, instead
+        # of being turned into a dict up front and walked again by the encoder
+        if include_raw:
+            response["raw_result"] = result
+
+        return Response(
+            content=orjson.dumps(response, default=azure_json_default),
+            media_type="application/json"
+        )
 
     except HttpResponseError as e:
         raise HTTPException(status_code=e.status_code, detail=f"Azure Error: {e.message}")
@@ -172,52 +632,67 @@ async def generate_pdf(invoice_data: dict):
         if "data" in invoice_data and "status" in invoice_data:
             invoice_data = invoice_data["data"]
         
+        invoice_id = invoice_data.get("InvoiceId", "invoice")
+        filename = f"invoice_{invoice_id}.pdf"
+        headers = {
+            "Content-Disposition": f'attachment; filename="{filename}"'
+        }
+        
+        # Serve repeated requests (e.g. retries) for the same invoice from cache
+        cache_key = None
+        if PDF_CACHE_SIZE:
+            try:
+                cache_key = hashlib.blake2b(
+                    orjson.dumps(invoice_data, option=orjson.OPT_SORT_KEYS)
+                ).digest()
+            except orjson.JSONEncodeError:
+                pass  # e.g. integers beyond 64 bits; render without caching
+        if cache_key is not None:
+            cached_pdf = pdf_cache.get(cache_key)
+            if cached_pdf is not None:
+                pdf_cache.move_to_end(cache_key)
+                return Response(content=cached_pdf, media_type="application/pdf", headers=headers)
+        
         # 1. Determine currency from the extracted data
         currency = ""  # default
         total_amount = invoice_data.get("TotalAmount")
         if isinstance(total_amount, dict):
             currency = total_amount.get("CurrencyCode", "")
         
-        # 2. Render the HTML template with Jinja2
-        template_dir = Path(__file__).parent
-        env = Environment(loader=FileSystemLoader(str(template_dir)))
-        template = env.get_template("template.html")
-        
-        rendered_html = template.render(
+        # 2. Render the pre-compiled HTML template with Jinja2
+        rendered_html = invoice_template.render(
             currency=currency,
             **invoice_data  # Spreads all fields as template variables
         )
         
-        # 3. Use Playwright to convert the rendered HTML into a PDF
-        async with async_playwright() as p:
-            browser = await p.chromium.launch()
-            page = await browser.new_page()
-            
-            await page.set_content(rendered_html, wait_until="networkidle")
+        # 3. Convert the rendered HTML into a PDF.
+        # When caching, the bytes are kept in memory anyway, so send them as-is
+        if cache_key is not None:
+            pdf_bytes = await render_pdf(rendered_html)
+            pdf_cache[cache_key] = pdf_bytes
+            if len(pdf_cache) > PDF_CACHE_SIZE:
+                pdf_cache.popitem(last=False)  # Evict the least recently used PDF
             
-            pdf_bytes = await page.pdf(
-                format="A4",
-                print_background=True,
-                margin={
-                    "top": "0mm",
-                    "bottom": "0mm",
-                    "left": "0mm",
-                    "right": "0mm"
-                }
-            )
-            
-            await browser.close()
+            # 4. Return the PDF as a downloadable file
+            return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
         
-        # 4. Return the PDF as a downloadable file
-        invoice_id = invoice_data.get("InvoiceId", "invoice")
-        filename = f"invoice_{invoice_id}.pdf"
+        # Otherwise the PDF is written to a temp file and streamed from disk,
+        # so the bytes don't stay in memory for as long as the client takes
+        # to download
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        try:
+            await render_pdf(rendered_html, pdf_path)
+        except Exception:
+            os.remove(pdf_path)
+            raise
         
-        return Response(
-            content=pdf_bytes,
+        # 4. Return the PDF as a downloadable file
+        return StreamingResponse(
+            iter_file(pdf_path),
             media_type="application/pdf",
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"'
-            }
+            headers=headers,
+            background=BackgroundTask(os.remove, pdf_path)  # Clean up after sending
         )
     
     except Exception as e:
@@ -225,4 +700,14 @@ async def generate_pdf(invoice_data: dict):
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Multiple workers need the app as an import string. Each worker is its
+    # own process with its own event loop, so each starts its own browser
+    # pool and Azure client in the startup handler.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
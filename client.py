@@ -1,11 +1,18 @@
 """
 Invoice Generator Client
 Selects a file → calls /analyze-invoice → calls /generate-pdf → saves the PDF locally.
+
+Batch mode: pass files and/or folders as arguments to process many invoices
+in parallel, e.g. `python client.py invoice-samples-input`.
 """
 
 import os
+import re
 import sys
+import mimetypes
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests_toolbelt import MultipartEncoder
 from tkinter import Tk, filedialog
 from dotenv import load_dotenv
 
@@ -13,6 +20,13 @@ load_dotenv(os.path.join(os.path.dirname(__file__), "app", ".env"))
 
 BASE_URL = "http://localhost:8000"
 API_KEY = os.getenv("AZURE_AI_KEY")
+HEADERS = {"X-API-Key": API_KEY}
+
+SUPPORTED_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".tiff", ".bmp")
+
+# Invoices processed concurrently in batch mode (the server also limits
+# concurrent Azure analyses, so extra requests just queue there)
+BATCH_WORKERS = 8
 
 def select_file():
     """Open a file picker dialog to select an invoice file."""
@@ -29,6 +43,57 @@ def select_file():
     root.destroy()
     return file_path
 
+def analyze_invoice(file_path):
+    """Upload a file to /analyze-invoice and return the JSON response."""
+    content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    with open(file_path, "rb") as f:
+        # Stream the multipart body from disk instead of building it in memory
+        encoder = MultipartEncoder(
+            fields={"file": (os.path.basename(file_path), f, content_type)}
+        )
+        response = requests.post(
+            f"{BASE_URL}/analyze-invoice",
+            headers={**HEADERS, "Content-Type": encoder.content_type},
+            data=encoder
+        )
+
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code} - {response.text}")
+    return response.json()
+
+def generate_pdf(result):
+    """Send an /analyze-invoice response to /generate-pdf and return the PDF bytes."""
+    pdf_response = requests.post(
+        f"{BASE_URL}/generate-pdf",
+        headers={**HEADERS, "Content-Type": "application/json"},
+        json=result  # Sends the full response; endpoint auto-unwraps
+    )
+
+    if pdf_response.status_code != 200:
+        raise RuntimeError(f"{pdf_response.status_code} - {pdf_response.text}")
+    return pdf_response.content
+
+def safe_filename(name):
+    """Replace characters that aren't safe in a file name (e.g. '/' in INV/2024/001)."""
+    return re.sub(r"[^\w.-]", "_", str(name))
+
+def save_pdf(result, pdf_bytes, source_file=None):
+    """
+    Save the PDF as invoice_<InvoiceId>.pdf and return its absolute path.
+    With source_file (batch mode), the name is prefixed with the source file
+    name so invoices sharing an ID don't overwrite each other.
+    """
+    invoice_id = result.get("data", {}).get("InvoiceId") or "invoice"
+    output_file = f"invoice_{safe_filename(invoice_id)}.pdf"
+    if source_file:
+        source_name = os.path.splitext(os.path.basename(source_file))[0]
+        output_file = f"{safe_filename(source_name)}_{output_file}"
+
+    with open(output_file, "wb") as f:
+        f.write(pdf_bytes)
+
+    return os.path.abspath(output_file)
+
 def main():
     # 1. Select file
     print("Opening file picker...")
@@ -40,44 +105,75 @@ def main():
 
     print(f"Selected: {file_path}")
 
-    headers = {"X-API-Key": API_KEY}
+    try:
+        # 2. Call /analyze-invoice
+        print("\n[Step 1] Analyzing invoice...")
+        result = analyze_invoice(file_path)
+        print(f"Extracted {len(result.get('data', {}))} fields.")
 
-    # 2. Call /analyze-invoice
-    print("\n[Step 1] Analyzing invoice...")
-    with open(file_path, "rb") as f:
-        response = requests.post(
-            f"{BASE_URL}/analyze-invoice",
-            headers=headers,
-            files={"file": (os.path.basename(file_path), f)}
-        )
+        # 3. Call /generate-pdf
+        print("\n[Step 2] Generating PDF...")
+        pdf_bytes = generate_pdf(result)
 
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} - {response.text}")
+        # 4. Save PDF
+        output_file = save_pdf(result, pdf_bytes)
+    except (RuntimeError, OSError) as e:
+        print(f"Error: {e}")
         return
 
-    result = response.json()
-    print(f"Extracted {len(result.get('data', {}))} fields.")
+    print(f"\n[Done] PDF saved to: {output_file}")
+
+def collect_files(paths):
+    """Expand folders into the supported invoice files they contain."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+    return files
+
+def process_invoice(file_path):
+    """Analyze one invoice and render its PDF; returns (result, pdf_bytes)."""
+    result = analyze_invoice(file_path)
+    return result, generate_pdf(result)
+
+def main_batch(paths):
+    """
+    Process many invoices in parallel. Each worker runs analyze → generate
+    for one file, so while one invoice is being analyzed another is already
+    being rendered and both server stages stay busy.
+    """
+    files = collect_files(paths)
+    if not files:
+        print("No invoice files found. Exiting.")
+        return
 
-    # 3. Call /generate-pdf
-    print("\n[Step 2] Generating PDF...")
-    pdf_response = requests.post(
-        f"{BASE_URL}/generate-pdf",
-        headers={**headers, "Content-Type": "application/json"},
-        json=result  # Sends the full response; endpoint auto-unwraps
-    )
+    print(f"Processing {len(files)} invoice(s) with up to {BATCH_WORKERS} in parallel...")
+    failed = 0
 
-    if pdf_response.status_code != 200:
-        print(f"Error: {pdf_response.status_code} - {pdf_response.text}")
-        return
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = {executor.submit(process_invoice, path): path for path in files}
 
-    # 4. Save PDF
-    invoice_id = result.get("data", {}).get("InvoiceId", "invoice")
-    output_file = f"invoice_{invoice_id}.pdf"
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                result, pdf_bytes = future.result()
+                output_file = save_pdf(result, pdf_bytes, source_file=file_path)
+            except Exception as e:
+                # One bad invoice counts as a failure instead of ending the run
+                failed += 1
+                print(f"[Error] {file_path}: {e}")
+                continue
 
-    with open(output_file, "wb") as f:
-        f.write(pdf_response.content)
+            print(f"[Done] {file_path} → {output_file}")
 
-    print(f"\n[Done] PDF saved to: {os.path.abspath(output_file)}")
+    print(f"\nFinished: {len(files) - failed} succeeded, {failed} failed.")
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        main_batch(sys.argv[1:])
+    else:
+        main()